@@ -16,7 +16,7 @@ Date: 11 Nov 2024
 """
 
 from specklepy.api.client import SpeckleClient
-from specklepy.api.credentials import get_account_from_token
+from specklepy.api.credentials import Account, get_account_from_token
 from specklepy.transports.server import ServerTransport
 from specklepy.api import operations
 from specklepy.objects import Base
@@ -24,14 +24,39 @@ import os
 from dotenv import load_dotenv
 import requests
 import re
+import json
+import hashlib
+import time
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv()
 print("LOADING ENVIRONMENT VARIABLES")
 
 
-changed_ids = []
-same_ids =[]
+# Speckle FE2 URL: https://host/projects/[stream]/models/[branch]@[commit]
+_SPECKLE_URL_RE = re.compile(r'https?://([^/]+)/projects/([^/]+)/models/([^@]+)@(.+)')
+
+# Sentinel for dictionary lookups where None is a valid value
+_MISSING = object()
+
+# Traversal node states: unvisited, on the current path, finished
+WHITE, GRAY, BLACK = 0, 1, 2
+
+# Trace-output indentation for each traversal depth, built once instead of per object
+_INDENTS = tuple("  " * depth for depth in range(64))
+
+# Class-level member names per Base subclass, filled lazily by get_member_names_cached
+_MEMBER_NAMES_CACHE = {}
+
+# Authenticated accounts are cached on disk so repeated runs can skip re-authentication.
+# The cache never holds the token itself: it is matched by hash and supplied again on load
+TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'speckle_updater', 'token.json')
+LEGACY_TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'speckle_updater', 'token.pkl')
+TOKEN_CACHE_TTL = 12 * 60 * 60  # seconds a cached account is trusted for
+TOKEN_CACHE_MIN_REMAINING = 60  # seconds of validity required to reuse a cached account
 
 def parse_speckle_url(url: str) -> dict:
     """
@@ -55,8 +80,7 @@ def parse_speckle_url(url: str) -> dict:
         }
     """
     try:
-        pattern = r'https?://([^/]+)/projects/([^/]+)/models/([^@]+)@(.+)'
-        match = re.match(pattern, url)
+        match = _SPECKLE_URL_RE.match(url)
         
         if match:
             return {
@@ -90,22 +114,180 @@ def sanitize_server_url(url: str) -> str:
     url = url.replace('//', '/')
     return url
 
-def get_safe_attribute(obj: object, attr: str) -> any:
+def get_indent(depth: int) -> str:
+    """
+    Get the trace-output indentation for a traversal depth.
+    
+    Args:
+        depth (int): The traversal depth
+    
+    Returns:
+        str: Two spaces per level of depth
+    """
+    return _INDENTS[depth] if depth < len(_INDENTS) else "  " * depth
+
+def get_member_names_cached(obj: Base) -> list:
+    """
+    Get the member names of a Speckle object, caching the class-level part per type.
+    
+    Base.get_member_names walks dir() of the instance on every call. Only the instance
+    dict differs between objects of the same type, so the remaining (class-level) names
+    are computed once per type and combined with the object's own dynamic properties.
+    
+    Args:
+        obj (Base): The Speckle object to get the member names of
+    
+    Returns:
+        list: The names of all public members, dynamic or not
+    """
+    obj_type = type(obj)
+    obj_dict = obj.__dict__
+    static_names = _MEMBER_NAMES_CACHE.get(obj_type)
+    if static_names is None:
+        static_names = frozenset(name for name in obj.get_member_names() if name not in obj_dict)
+        _MEMBER_NAMES_CACHE[obj_type] = static_names
+    
+    member_names = list(static_names)
+    # Same filter as Base.get_member_names: public, non-callable members only
+    member_names.extend(
+        name for name, value in obj_dict.items()
+        if not name.startswith('_') and name not in static_names and not callable(value)
+    )
+    return member_names
+
+def hash_token(token: str) -> str:
+    """
+    Hash an authentication token so it can identify a cache entry without being stored.
+    
+    Args:
+        token (str): The authentication token to hash
+    
+    Returns:
+        str: Hex digest of the token
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def load_cached_account(token: str, server: str, stream_id: str) -> Account:
     """
-    Safely retrieve an attribute from an object without raising exceptions.
+    Load a previously authenticated account from the on-disk token cache.
     
     Args:
-        obj (object): The object to get the attribute from
-        attr (str): The name of the attribute to retrieve
+        token (str): The authentication token the account must belong to
+        server (str): The Speckle server host the account must belong to
+        stream_id (str): The stream the account's permissions were verified for
     
     Returns:
-        any: The attribute value if it exists, None otherwise
+        Account: The cached account if it matches and is still valid, None otherwise
     """
+    # Any unreadable, malformed or mismatching cache file is treated as a cache miss
     try:
-        return getattr(obj, attr, None)
-    except:
+        with open(TOKEN_CACHE_PATH, 'r', encoding='utf-8') as cache_file:
+            cached = json.load(cache_file)
+        
+        if not isinstance(cached, dict):
+            return None
+        if (cached.get('token_hash') != hash_token(token) or cached.get('server') != server
+                or cached.get('stream_id') != stream_id):
+            return None
+        expires_at = cached.get('expires_at')
+        if not isinstance(expires_at, (int, float)) or isinstance(expires_at, bool):
+            return None
+        if expires_at - time.time() <= TOKEN_CACHE_MIN_REMAINING:
+            return None
+        account_data = cached.get('account')
+        if not isinstance(account_data, dict):
+            return None
+        return Account(**account_data, token=token)
+    except Exception:
         return None
 
+def save_cached_account(token: str, server: str, stream_id: str, account: Account) -> None:
+    """
+    Store an authenticated account in the on-disk token cache.
+    
+    Args:
+        token (str): The authentication token used for the account
+        server (str): The Speckle server host
+        stream_id (str): The stream the account's permissions were verified for
+        account (Account): The authenticated account to cache
+    """
+    try:
+        dump_account = getattr(account, 'model_dump', None) or account.dict
+        account_data = dump_account(exclude={'token', 'refreshToken'})
+        
+        os.makedirs(os.path.dirname(TOKEN_CACHE_PATH), exist_ok=True)
+        # Readable by the owner only, including when an older cache file already exists
+        cache_fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(TOKEN_CACHE_PATH, 0o600)
+        with os.fdopen(cache_fd, 'w', encoding='utf-8') as cache_file:
+            json.dump({
+                'token_hash': hash_token(token),
+                'server': server,
+                'stream_id': stream_id,
+                'account': account_data,
+                'expires_at': time.time() + TOKEN_CACHE_TTL
+            }, cache_file, default=str)
+    except Exception as e:
+        print(f"WARNING: COULD NOT CACHE CREDENTIALS: {str(e)}")
+    
+    # Earlier versions pickled the account together with its plaintext token
+    try:
+        os.remove(LEGACY_TOKEN_CACHE_PATH)
+    except OSError:
+        pass
+
+def clear_cached_account() -> None:
+    """
+    Remove the on-disk token cache, forcing the next run to re-authenticate.
+    """
+    try:
+        os.remove(TOKEN_CACHE_PATH)
+    except FileNotFoundError:
+        pass
+
+def is_unauthorized_error(error: Exception) -> bool:
+    """
+    Check whether an exception was caused by the server rejecting the credentials.
+    
+    Only the HTTP status is trusted, never the message text, which may contain object or
+    commit ids. requests errors carry it on their response, gql's TransportServerError as
+    its code, and specklepy wraps the gql error in SpeckleException.exception.
+    
+    Args:
+        error (Exception): The exception to inspect
+    
+    Returns:
+        bool: True if the credentials were rejected, False otherwise
+    """
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) == 401:
+        return True
+    if getattr(error, 'code', None) == 401:
+        return True
+    return getattr(getattr(error, 'exception', None), 'code', None) == 401
+
+def should_retry_unauthorized(error: Exception, using_cached_account: bool, retry_unauthorized: bool) -> bool:
+    """
+    Invalidate the token cache if the server rejected the credentials, and decide whether to retry.
+    
+    Args:
+        error (Exception): The exception raised by the failed request
+        using_cached_account (bool): Whether the rejected credentials came from the cache
+        retry_unauthorized (bool): Whether a retry is still allowed for this run
+    
+    Returns:
+        bool: True if the run should be retried with fresh authentication, False otherwise
+    """
+    if not is_unauthorized_error(error):
+        return False
+    
+    print("AUTHENTICATION ERROR - CHECK TOKEN AND PERMISSIONS")
+    clear_cached_account()
+    if using_cached_account and retry_unauthorized:
+        print("CACHED CREDENTIALS REJECTED - RETRYING WITH FRESH AUTHENTICATION")
+        return True
+    return False
+
 def verify_token_and_permissions(client: SpeckleClient, stream_id: str, token: str) -> bool:
     """
     Verify that the provided token is valid and has necessary permissions.
@@ -130,114 +312,179 @@ def verify_token_and_permissions(client: SpeckleClient, stream_id: str, token: s
         print(f"AUTHENTICATION/PERMISSION CHECK FAILED: {str(e)}")
         return False
 
-def process_object(obj: Base, transport: ServerTransport, SpeckleId: str, target_key: str, target_value: str, depth: int = 0, 
-                  max_depth: int = 10, processed: set = None) -> bool:
+def process_object(obj: Base, SpeckleId: str, target_key: str, target_value: str, changed_ids: list,
+                  same_ids: list, depth: int = 0, max_pending: int = None,
+                  states: dict = None, verbose: bool = False) -> bool:
     """
     Process and potentially modify a Speckle object and its sub-objects.
     
     This function traverses through a Speckle object graph, processing each object
-    and its children up to a maximum depth. It modifies the "test" parameter to the target value
-    and handles circular references.
+    and all of its children. It modifies the target parameter to the target value.
+    The traversal is iterative (explicit stack), so deep graphs do not hit Python's
+    recursion limit, and there is no depth cap: objects are marked GRAY while their
+    subtree is being walked and BLACK once it is done, so shared objects are processed
+    once and only a real cycle (reaching a GRAY object again) is treated as an error.
+    
+    The object graph must already be fully received: operations.receive copies the whole
+    closure into its local transport before deserializing, so no requests are made while
+    traversing and the walk is CPU-bound and kept single-threaded.
     
     Args:
         obj (Base): The Speckle object to process
-        transport (ServerTransport): The transport being used
-        target_value (str): The value to set for the "test" parameter
-        depth (int): Current recursion depth
-        max_depth (int): Maximum recursion depth to prevent infinite loops
-        processed (set): Set of already processed object IDs
+        SpeckleId (str): The ID of the object being looked for
+        target_key (str): The name of the parameter to update
+        target_value (str): The value to set for the target parameter
+        changed_ids (list): List the IDs of updated objects are appended to
+        same_ids (list): List the IDs of objects other than SpeckleId are appended to
+        depth (int): Starting depth of the traversal
+        max_pending (int): Optional cap on the number of objects waiting to be visited, for
+                           callers that prefer failing over using unbounded memory. None (the
+                           default) lets the traversal grow with the graph
+        states (dict): Traversal state (GRAY/BLACK) of each object, keyed by id()
+        verbose (bool): Print a trace line for every visited object, member and list item.
+                        Off by default, as on large graphs the per-node output dominates runtime
         
     Returns:
         bool: True if any changes were made, False otherwise
+    
+    Raises:
+        ValueError: If the graph contains a cycle, or more than max_pending objects are waiting
     """
-    if processed is None:
-        processed = set()
+    if states is None:
+        states = {}
         
-    changes_made = False
+    # Attribute names set on objects are interned, so interning the inputs lets every
+    # dict probe and id comparison below match by pointer before comparing characters
+    SpeckleId = sys.intern(SpeckleId)
+    target_key = sys.intern(target_key)
+    
+    initial_changes = len(changed_ids)
+    stack = deque([(obj, depth)])
+    pending = 1  # objects on the stack, not counting exit markers
+    
+    # The per-run inputs are fixed for the whole walk, so bind what the loop calls on every
+    # node to locals once instead of resolving the attributes again for each object
+    pop_node = stack.pop
+    get_state = states.get
+    add_same_id = same_ids.append
+    add_changed_id = changed_ids.append
+    
+    while stack:
+        obj, depth = pop_node()
         
-    if depth > max_depth:
-        print(f"{'  ' * depth}MAX DEPTH REACHED")
-        return changes_made
+        # The subtree of an object has been fully walked once its exit marker pops
+        if depth is None:
+            states[id(obj)] = BLACK
+            continue
+        pending -= 1
+            
+        if not isinstance(obj, Base):
+            continue
+            
+        # Base stores its instance props (including id) in __dict__, so probe it directly
+        obj_dict = obj.__dict__
+        obj_id = obj_dict.get('id')
         
-    if not isinstance(obj, Base):
-        return changes_made
+        # Cycles go through the same in-memory instance, so its identity is enough to detect them
+        obj_key = id(obj)
+        state = get_state(obj_key, WHITE)
+        if state == GRAY:
+            raise ValueError(f"Cycle detected at object {obj_id or 'No ID'}")
+        if state == BLACK:
+            if verbose:
+                print(f"{get_indent(depth)}ALREADY PROCESSED: {obj_id or 'No ID'}")
+            continue
+            
+        states[obj_key] = GRAY
         
-    obj_id = get_safe_attribute(obj, 'id')
-
-
-    
-    if obj_id and obj_id in processed:
-        print(f"{'  ' * depth}ALREADY PROCESSED: {obj_id}")
-        return changes_made
+        # Only needed for output, so it is not built at all when tracing is off
+        if verbose:
+            indent = get_indent(depth)
+            print(f"{indent}PROCESSING OBJECT: {obj_id or 'No ID'}")
+            print(f"{indent}TYPE: {getattr(obj, 'speckle_type', None) or 'Unknown type'}")
         
-    if obj_id:
-        processed.add(obj_id)
-    
-    indent = "  " * depth
-    print(f"{indent}PROCESSING OBJECT: {obj_id or 'No ID'}")
-    print(f"{indent}TYPE: {get_safe_attribute(obj, 'speckle_type') or 'Unknown type'}")
-    
-    # print obj_id and  SpeckleId
-
-
-    if obj_id != SpeckleId:
-        same_ids.append( obj_id)
-
-    # if obj_id != SpeckleId:
-    #     print(f"{'  ' * depth} SKIPPING OBJ: {obj_id}")
-    #     return 
-
-    # Process the test parameter if present
-    if hasattr(obj, target_key):
-        old_value = obj[target_key]
-        obj[target_key] = target_value
-        print(f"{indent}UPDATED TEST PARAMETER: '{old_value}' -> '{target_value}'")
-        changed_ids.append(obj_id)
-        changes_made = True
-    
-    # Process child objects
-    try:
-        # Get member names safely
-        member_names = obj.get_member_names() if hasattr(obj, 'get_member_names') else []
+        if obj_id and obj_id != SpeckleId:
+            add_same_id(obj_id)
         
-        for name in member_names:
+        # Process the target parameter if present. Dynamic props live in the instance dict;
+        # typed or class-level props with a default only resolve through getattr
+        old_value = obj_dict.get(target_key, _MISSING)
+        if old_value is _MISSING:
+            old_value = getattr(obj, target_key, _MISSING)
+        if old_value is not _MISSING:
+            # Written through Base.__setitem__ like the original code, which stores the value
+            # without type-checking it; a write that fails or does not take effect is skipped
             try:
-                value = getattr(obj, name)
-                
-                # Handle Base objects
-                if isinstance(value, Base):
-                    print(f"{indent}ENTERING SUB-OBJECT: {name}")
-                    sub_changes = process_object(value, transport,SpeckleId,target_key ,target_value, depth + 1, max_depth, processed)
-                    changes_made = changes_made or sub_changes
-                
-                # Handle lists of Base objects
-                elif isinstance(value, list):
-                    print(f"{indent}PROCESSING LIST: {name} ({len(value)} items)")
-                    for i, item in enumerate(value):
-                        if isinstance(item, Base):
-                            print(f"{indent}PROCESSING LIST ITEM {i + 1}/{len(value)}")
-                            sub_changes = process_object(item, transport, SpeckleId, target_key, target_value, depth + 1, max_depth, processed)
-                            changes_made = changes_made or sub_changes
-                            
+                if old_value != target_value:
+                    obj[target_key] = target_value
+                    if getattr(obj, target_key, _MISSING) == target_value:
+                        print(f"{get_indent(depth)}UPDATED TEST PARAMETER: '{old_value}' -> '{target_value}'")
+                        add_changed_id(obj_id)
+                    else:
+                        print(f"{get_indent(depth)}PARAMETER NOT UPDATED: {target_key} on {obj_id or 'No ID'}")
             except Exception as e:
-                print(f"{indent}ERROR PROCESSING MEMBER {name}: {str(e)}")
-                continue
-                
-    except Exception as e:
-        print(f"{indent}ERROR PROCESSING OBJECT: {str(e)}")
+                print(f"{get_indent(depth)}ERROR UPDATING PARAMETER {target_key}: {str(e)}")
+        
+        # Collect child objects; they are pushed in reverse so they pop in member order
+        children = []
+        try:
+            # Get member names safely
+            member_names = get_member_names_cached(obj) if hasattr(obj, 'get_member_names') else []
+            
+            for name in member_names:
+                try:
+                    # Dynamic and typed props live in the instance dict; only class-level names need getattr
+                    value = obj_dict.get(name, _MISSING)
+                    if value is _MISSING:
+                        value = getattr(obj, name)
+                    
+                    # Handle Base objects
+                    if isinstance(value, Base):
+                        if verbose:
+                            print(f"{indent}ENTERING SUB-OBJECT: {name}")
+                        children.append(value)
+                    
+                    # Handle lists of Base objects
+                    elif isinstance(value, list):
+                        if verbose:
+                            print(f"{indent}PROCESSING LIST: {name} ({len(value)} items)")
+                        for i, item in enumerate(value):
+                            if isinstance(item, Base):
+                                if verbose:
+                                    print(f"{indent}PROCESSING LIST ITEM {i + 1}/{len(value)}")
+                                children.append(item)
+                                
+                except Exception as e:
+                    print(f"{get_indent(depth)}ERROR PROCESSING MEMBER {name}: {str(e)}")
+                    continue
+                    
+        except Exception as e:
+            print(f"{get_indent(depth)}ERROR PROCESSING OBJECT: {str(e)}")
+        
+        # The exit marker sits below the children, so it pops once the whole subtree is done
+        stack.append((obj, None))
+        child_depth = depth + 1
+        stack.extend((child, child_depth) for child in reversed(children))
+        pending += len(children)
+        if max_pending is not None and pending > max_pending:
+            raise ValueError(f"More than {max_pending} objects pending traversal")
     
-    return changes_made
+    return len(changed_ids) > initial_changes
 
-def main():
+def main(retry_unauthorized: bool = True):
     """
     Main execution function for the Speckle object processing script.
     
     This function:
     1. Parses a Speckle FE2 URL
-    2. Authenticates with the Speckle server
+    2. Authenticates with the Speckle server (reusing cached credentials when valid)
     3. Processes and modifies the specified object
     4. Creates a new commit with the modified object
     
+    Args:
+        retry_unauthorized (bool): Whether to re-authenticate and retry once when the
+                                   server rejects cached credentials
+    
     Environment Variables Required:
         SPECKLE_TOKEN: Your Speckle authentication token
     """
@@ -263,20 +510,29 @@ def main():
         print("BRANCH:", url_parts['branch_name'])
         print("COMMIT:", url_parts['commit_id'])
         
-        # Initialize Speckle client
+        # Initialize Speckle client, reusing a cached account if one is still valid
+        account = load_cached_account(token, server, url_parts['stream_id'])
+        using_cached_account = account is not None
         try:
             client = SpeckleClient(host=server)
-            account = get_account_from_token(token, server)
+            if not using_cached_account:
+                account = get_account_from_token(token, server)
             client.authenticate_with_account(account)
             print("AUTHENTICATION SUCCESSFUL")
         except Exception as e:
             print(f"AUTHENTICATION FAILED: {str(e)}")
+            if should_retry_unauthorized(e, using_cached_account, retry_unauthorized):
+                return main(retry_unauthorized=False)
             return
 
-        # Verify permissions
-        if not verify_token_and_permissions(client, url_parts['stream_id'], token):
+        # Verify permissions (already done for cached accounts)
+        if using_cached_account:
+            print("USING CACHED CREDENTIALS")
+        elif not verify_token_and_permissions(client, url_parts['stream_id'], token):
             print("PERMISSION VERIFICATION FAILED")
             return
+        else:
+            save_cached_account(token, server, url_parts['stream_id'], account)
             
         # Create transport with explicit authentication
         transport = ServerTransport(
@@ -288,6 +544,9 @@ def main():
         # Get commit object
         try:
             commit = client.commit.get(url_parts['stream_id'], url_parts['commit_id'])
+            # specklepy's make_request returns, rather than raises, the error of a failed query
+            if isinstance(commit, Exception):
+                raise commit
             if not commit:
                 print("ERROR: COULD NOT FIND SPECIFIED COMMIT")
                 return
@@ -295,7 +554,16 @@ def main():
             print("REFERENCED OBJECT ID:", obj_id)
         except Exception as e:
             print(f"ERROR GETTING COMMIT: {str(e)}")
+            if should_retry_unauthorized(e, using_cached_account, retry_unauthorized):
+                return main(retry_unauthorized=False)
             return
+        
+        # The pre-send stream check runs while the object is received and processed. Those only
+        # use the transport's session; the gql client must not run two queries at once, so the
+        # check is started only after commit.get returns and the client is not touched until it ends
+        executor = ThreadPoolExecutor(max_workers=1)
+        stream_future = executor.submit(client.stream.get, url_parts['stream_id'])
+        executor.shutdown(wait=False)
             
         # Receive and process object
         try:
@@ -306,7 +574,9 @@ def main():
             print("\nPROCESSING OBJECT...")
 
             ####
-            process_object(obj, transport, 'the_specl', "SF_GEN_Weight_t", "200") ### here you update the parameter value for "test"
+            changed_ids = []
+            same_ids = []
+            process_object(obj, 'the_specl', "SF_GEN_Weight_t", "200", changed_ids, same_ids) ### here you update the parameter value for "test"
            
            
            
@@ -318,6 +588,8 @@ def main():
             
         except Exception as e:
             print(f"ERROR RECEIVING/PROCESSING OBJECT: {str(e)}")
+            if should_retry_unauthorized(e, using_cached_account, retry_unauthorized):
+                return main(retry_unauthorized=False)
             return
             
         # Send modified object
@@ -327,7 +599,9 @@ def main():
             print("DEBUG - Stream ID:", transport.stream_id)
             
             # Verify stream exists before sending
-            stream = client.stream.get(url_parts['stream_id'])
+            stream = stream_future.result()
+            if isinstance(stream, Exception):
+                raise stream
             if not stream:
                 print(f"ERROR: STREAM {url_parts['stream_id']} NOT FOUND")
                 return
@@ -343,6 +617,8 @@ def main():
                 branch_name=url_parts['branch_name'],
                 message="Updated userStrings.test value to 'test2'"
             )
+            if isinstance(new_commit, Exception):
+                raise new_commit
             print("NEW COMMIT CREATED WITH ID:", new_commit)
             print("\nPROCESS COMPLETED SUCCESSFULLY")
             print("CHANGED OBJECT IDS:", changed_ids)
@@ -352,7 +628,8 @@ def main():
         except requests.exceptions.HTTPError as e:
             print(f"HTTP ERROR DURING SEND: {str(e)}")
             if e.response.status_code == 401:
-                print("AUTHENTICATION ERROR - CHECK TOKEN AND PERMISSIONS")
+                if should_retry_unauthorized(e, using_cached_account, retry_unauthorized):
+                    return main(retry_unauthorized=False)
             elif e.response.status_code == 403:
                 print("PERMISSION DENIED - NO ACCESS TO THIS STREAM")
             else:
@@ -360,6 +637,8 @@ def main():
             return
         except Exception as e:
             print(f"ERROR DURING SEND/COMMIT: {str(e)}")
+            if should_retry_unauthorized(e, using_cached_account, retry_unauthorized):
+                return main(retry_unauthorized=False)
             return
 
     except Exception as e: